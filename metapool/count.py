@@ -1,10 +1,25 @@
 import re
+import numpy as np
 import pandas as pd
 import warnings
+from os import scandir
 from os.path import join, abspath, basename, exists
+from fnmatch import translate
 from glob import glob
-from subprocess import Popen, PIPE
-from json import load
+from concurrent.futures import ThreadPoolExecutor
+from json import load, JSONDecodeError
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ISA-L inflates considerably faster than zlib and does so in a background
+# thread, fall back to the standard library when it isn't installed
+try:
+    from isal.igzip_threaded import open as gzip_open
+except ImportError:
+    from gzip import open as gzip_open
 
 
 # first group is the sample name from the sample sheet, second group is the
@@ -16,9 +31,14 @@ import metapool
 
 SAMPLE_PATTERN = re.compile(r'(.*)_(S\d{1,4})_(L\d{1,3})_([RI][12]).*')
 
+# first group is the sample name and second group is the forward/reverse id
+# of the quality-controlled sequence files.
+_TRIMMED_FASTQ_PATTERN = re.compile(
+    r'^(.*)_S\d+_L\d{3}_(R\d)_\d{3}\.trimmed\.fastq\.gz$')
+
 
 def _extract_name_and_lane(filename):
-    search = re.match(SAMPLE_PATTERN, filename)
+    search = SAMPLE_PATTERN.match(filename)
     if search is None:
         raise ValueError(f'Unrecognized filename pattern {filename}')
 
@@ -30,19 +50,89 @@ def _extract_name_and_lane(filename):
 
 
 def _parse_fastp_counts(path):
-    with open(path) as fp:
-        stats = load(fp)
+    malformed = f'The fastp log for {path} is malformed'
+
+    with open(path, 'rb') as fp:
+        if ijson is not None:
+            # fastp reports carry several MB of histograms we don't use and
+            # the summary comes first, so stream the document and stop as
+            # soon as the count shows up
+            try:
+                for prefix, event, value in ijson.parse(fp):
+                    if (prefix == 'summary.after_filtering.total_reads' and
+                       event in ('number', 'string')):
+                        return int(value)
+            except ijson.JSONError:
+                raise ValueError(malformed)
+
+            raise ValueError(malformed)
+
+        try:
+            stats = load(fp)
+        except JSONDecodeError:
+            raise ValueError(malformed)
 
         # check all the required keys are present, otherwise the file could be
         # malformed and we would only see a weird KeyError exception
         if ('summary' not in stats or
             'after_filtering' not in stats['summary'] or
            'total_reads' not in stats['summary']['after_filtering']):
-            raise ValueError(f'The fastp log for {path} is malformed')
+            raise ValueError(malformed)
 
         return int(stats['summary']['after_filtering']['total_reads'])
 
 
+def _count_sequences_in_fastq(path):
+    """Count the records in a gzipped FASTQ file
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped FASTQ file.
+
+    Returns
+    -------
+    int
+        Number of sequences in the file.
+
+    Raises
+    ------
+    ValueError
+        If the number of lines in the file is not a multiple of four. A
+        single blank line after the last record is tolerated, any other
+        blank lines are counted.
+    OSError
+        If the file is not gzip-compressed, uncompressed FASTQ files are not
+        supported.
+    """
+    # every FASTQ record spans exactly four lines, so rather than parsing
+    # each record we count newlines over large decompressed chunks
+    buf = bytearray(1 << 20)
+    lines = 0
+    tail = b''
+
+    with gzip_open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            lines += buf.count(b'\n', 0, n)
+            tail = (tail + buf[max(n - 2, 0):n])[-2:]
+
+    # account for a final record that isn't newline-terminated
+    if tail and not tail.endswith(b'\n'):
+        lines += 1
+    # and for a trailing blank line after the last record
+    elif tail == b'\n\n' and lines % 4 == 1:
+        lines -= 1
+
+    if lines % 4 != 0:
+        raise ValueError(f'{path} does not look like a FASTQ file, it has '
+                         f'{lines} lines')
+
+    return lines // 4
+
+
 def _parsefier(run_dir, metadata, subdir, suffix, name, funk):
     """High order helper to search through a run directory
 
@@ -66,42 +156,67 @@ def _parsefier(run_dir, metadata, subdir, suffix, name, funk):
     pd.DataFrame
         Table with sample, lane and counts.
     """
-    out = []
+    sample_ids = []
+    lanes = []
+    projects_list = []
+    paths = []
+    found = set()
 
-    if isinstance(metadata, metapool.KLSampleSheet):
-        projects = {(s.Sample_Project, s.Lane) for s in metadata}
-        expected = {s.Sample_ID for s in metadata}
-    else:
+    if not isinstance(metadata, metapool.KLSampleSheet):
         raise ValueError("counts not implemented for amplicon")
 
-    for project, lane in projects:
-        lane = lane.zfill(3)
-
-        # log files are named after the sequence files themselves,
-        # specifically the forward sequences, so we just make sure we
-        # match the right lane, the forward file and the suffix. The
-        # suffix is something like ".log" or "*.json" if you expect to see
-        # other characters before the extension.
-        logs = glob(join(run_dir, project, subdir,
-                         f'*_L{lane}_R1_001' + suffix))
-
-        for log in logs:
-            out.append([*_extract_name_and_lane(basename(log)),
-                        project, log])
-
-    out = pd.DataFrame(
-        columns=['Sample_ID', 'Lane', 'Sample_Project', 'path'],
-        data=out)
-
-    found = set(out['Sample_ID'])
-
-    # ignore the things not present in the sheet
-    out = out[out['Sample_ID'].isin(expected)]
-
-    dups = out.duplicated(subset=['Sample_ID', 'Lane'])
+    # group the lanes by project so each project directory is listed once
+    lanes_by_project = {}
+    expected = set()
+    for sample in metadata:
+        lanes_by_project.setdefault(sample.Sample_Project,
+                                    set()).add(sample.Lane.zfill(3))
+        expected.add(sample.Sample_ID)
+
+    # log files are named after the sequence files themselves, specifically
+    # the forward sequences, so we just make sure we match the forward file
+    # and the suffix, and capture the lane. The suffix is something like
+    # ".log" or "*.json" if you expect to see other characters before the
+    # extension, hence it's translated with glob semantics.
+    pattern = re.compile(r'(?s:.*)_L(\d{3})_R1_001' + translate(suffix))
+
+    for project, project_lanes in lanes_by_project.items():
+        logs = {}
+        try:
+            with scandir(join(run_dir, project, subdir)) as entries:
+                for entry in entries:
+                    # like glob, ignore hidden files
+                    if entry.name.startswith('.'):
+                        continue
+
+                    match = pattern.match(entry.name)
+                    if match is not None:
+                        logs.setdefault(match[1], []).append(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        for lane in project_lanes:
+            for log in logs.get(lane, []):
+                sample_id, log_lane = _extract_name_and_lane(basename(log))
+
+                # ignore the things not present in the sheet
+                if sample_id not in expected:
+                    continue
+
+                found.add(sample_id)
+                sample_ids.append(sample_id)
+                lanes.append(log_lane)
+                projects_list.append(project)
+                paths.append(log)
+
+    out = pd.DataFrame({'Sample_ID': sample_ids, 'Lane': lanes,
+                        'Sample_Project': projects_list, 'path': paths})
+
+    matches = out.groupby(['Sample_ID', 'Lane']).size()
+    dups = matches > 1
     if dups.any():
-        pairs = [f"{r['Sample_ID']} in lane {r['Lane']}"
-                 for _, r in out[dups].iterrows()]
+        pairs = [f"{sample_id} in lane {lane}"
+                 for sample_id, lane in matches.index[dups]]
 
         # when running bcl2fastq/bclconvert multiple times you can run
         # into situations where the cell number is the only thing that
@@ -117,7 +232,8 @@ def _parsefier(run_dir, metadata, subdir, suffix, name, funk):
 
     # quality_filtered_reads and the like are added as columns to the output
     # dataframe here.
-    out[name] = out.path.apply(funk).astype('float64')
+    out[name] = np.fromiter((funk(path) for path in out['path']),
+                            dtype=np.float64, count=len(out))
 
     # drop columns that are no longer needed from the output.
     out.drop(columns=['path', 'Sample_Project'], inplace=True)
@@ -141,16 +257,24 @@ def raw_read_counts(run_dir, sample_sheet):
     bclconvert_path = join(abspath(run_dir), 'Reports/Demultiplex_Stats.csv')
     seqcounts_path = join(abspath(run_dir), 'Reports/SeqCounts.csv')
 
-    count = 0
     found = []
-    for item in [bcl2fastq_path, bclconvert_path, seqcounts_path]:
-        if exists(item):
-            count += 1
-            found.append(item)
+    if exists(bcl2fastq_path):
+        found.append(bcl2fastq_path)
+
+    # both of bcl-convert's reports live in the same directory, so list it
+    # once rather than stat'ing each of them
+    try:
+        with scandir(join(abspath(run_dir), 'Reports')) as entries:
+            reports = {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        reports = set()
 
-        if count > 1:
-            raise IOError("multiple metadata files exist: %s",
-                          ', '.join(found))
+    found.extend(item for item in [bclconvert_path, seqcounts_path]
+                 if basename(item) in reports)
+
+    if len(found) > 1:
+        raise IOError("multiple metadata files exist: %s" %
+                      ', '.join(found))
 
     if len(found) == 0:
         raise IOError(f"Cannot find Stats.json '{bcl2fastq_path}' or "
@@ -171,43 +295,45 @@ def _bcl2fastq_counts(path):
     with open(path) as fp:
         contents = load(fp)
 
-    out = []
+    records = []
     for lane in _safe_get(contents, 'ConversionResults'):
-        table = pd.DataFrame(_safe_get(lane, 'DemuxResults'))
-        table['Lane'] = str(_safe_get(lane, 'LaneNumber'))
+        results = _safe_get(lane, 'DemuxResults')
+        lane_number = str(_safe_get(lane, 'LaneNumber'))
 
-        out.append(table)
+        for result in results:
+            records.append((result['SampleId'], lane_number,
+                            result['NumberReads']))
 
-    out = pd.concat(out)
-    out.rename(columns={'SampleId': 'Sample_ID',
-                        'NumberReads': 'raw_reads_r1r2'},
-               inplace=True)
-    out = out[['Sample_ID', 'Lane', 'raw_reads_r1r2']]
+    out = pd.DataFrame.from_records(
+        records, columns=['Sample_ID', 'Lane', 'raw_reads_r1r2'])
     out.set_index(['Sample_ID', 'Lane'], inplace=True, verify_integrity=True)
     return out
 
 
 def _bclconvert_counts(path):
-    # read the csv in from file
-    df = pd.read_csv(path)
-    # subselect only the columns we're concerned with
-    df = df[["SampleID", "Lane", "# Reads"]]
+    columns = ["SampleID", "Lane", "# Reads"]
+
+    # read the csv in from file, parsing only the columns we're concerned
+    # with. A callable is used so that a missing column surfaces as a
+    # KeyError when subselecting below.
+    df = pd.read_csv(path, usecols=lambda column: column in columns,
+                     dtype={'SampleID': str, 'Lane': str, '# Reads': 'int64'})
+    df = df[columns]
 
     # drop rows that have '# Reads' equal to zero. These correspond
-    # to samples w/zero-length files.
-    df = df[df['# Reads'] != 0]
+    # to samples w/zero-length files. Also filter out rows that reference
+    # an 'Undetermined' fastq.gz file and create our own copy to return to
+    # the user.
+    df = df.loc[(df['# Reads'] != 0) &
+                (df['SampleID'] != 'Undetermined')].copy()
 
     # double # Reads to represent forward and reverse reads.
-    df['raw_reads_r1r2'] = df['# Reads'] * 2
+    df['raw_reads_r1r2'] = df['# Reads'].to_numpy() * 2
     df.drop('# Reads', axis=1, inplace=True)
 
-    # filter out rows that reference an 'Undetermined' fastq.gz file
-    # and create our own copy to return to the user
-    df = df.loc[df['SampleID'] != 'Undetermined'].copy()
     # rename columns to standard values for metapool
     df.rename(columns={'SampleID': 'Sample_ID'}, inplace=True)
     # create indexes on these columns
-    df['Lane'] = df['Lane'].astype(str)
     df.set_index(['Sample_ID', 'Lane'], inplace=True, verify_integrity=True)
 
     return df
@@ -237,17 +363,20 @@ def fastp_counts(run_dir, metadata):
 
 
 def direct_sequence_counts(run_dir, metadata):
-    if isinstance(metadata, metapool.KLSampleSheet):
-        projects = {(s.Sample_Project, s.Lane) for s in metadata}
-    else:
+    if not isinstance(metadata, metapool.KLSampleSheet):
         raise ValueError("counts not implemented for amplicon")
 
-    sample_ids = []
-    lanes = []
-    counts = []
+    lanes_by_project = {}
+    for sample in metadata:
+        lanes_by_project.setdefault(sample.Sample_Project,
+                                    set()).add(sample.Lane)
+
+    # the same lanes repeat across projects, so build their patterns once
+    patterns = {lane: '*_L%s_R?_001.trimmed.fastq.gz' % lane.zfill(3)
+                for lanes in lanes_by_project.values() for lane in lanes}
 
-    for project, lane in projects:
-        samples = {}
+    files = []
+    for project, lanes in lanes_by_project.items():
         if join(run_dir, 'filtered_sequences'):
             subdir = join(run_dir, project, 'filtered_sequences')
         elif join(run_dir, 'trimmed_sequences'):
@@ -256,52 +385,48 @@ def direct_sequence_counts(run_dir, metadata):
             raise ValueError("'filtered_sequences', 'trimmed_sequences' "
                              "directories do not exist")
 
-        fp = join(subdir, '*_L%s_R?_001.trimmed.fastq.gz' % lane.zfill(3))
-
-        for item in glob(fp):
-            cmd = ['seqtk', 'size', item]
-
-            proc = Popen(' '.join(cmd), universal_newlines=True,
-                         shell=True,
-                         stdout=PIPE, stderr=PIPE)
+        for lane in lanes:
+            for item in glob(join(subdir, patterns[lane])):
+                m = _TRIMMED_FASTQ_PATTERN.match(basename(item))
 
-            stdout, stderr = proc.communicate()
-            return_code = proc.returncode
+                if m is None:
+                    raise ValueError(f"{item} doesn't match")
 
-            if return_code != 0:
-                msg = "seqtk error: %s\n%s" % (stdout, stderr)
-                raise ValueError("could not read %s: %s" % (item, msg))
+                if m[2] not in ['R1', 'R2']:
+                    raise ValueError("could not parse '%s'" % basename(item))
 
-            # split output and extract first value from results like:
-            # 17088755    2516404944
-            line_count = int(stdout.split('\t')[0])
+                files.append((project, lane, m[1], m[2], item))
 
-            m = re.match(r"^(.*)_S\d+_L\d\d\d_(R\d)_\d\d\d.trimmed.fastq.gz$",
-                         basename(item))
+    # each file is counted independently and zlib releases the GIL while
+    # inflating, so a thread pool is enough to spread the work across cores
+    with ThreadPoolExecutor() as executor:
+        line_counts = list(executor.map(_count_sequences_in_fastq,
+                                        [item for *_, item in files]))
 
-            if m is None:
-                raise ValueError(f"{item} doesn't match")
+    samples = {}
+    for (project, lane, name, read, _), line_count in zip(files,
+                                                          line_counts):
+        if (project, lane, name) not in samples:
+            # if this is the first read for this sample, create a dict
+            # to record the relevant information.
+            samples[(project, lane, name)] = {'R1': 0, 'R2': 0,
+                                              'name': name, 'lane': lane}
 
-            if m[1] not in samples:
-                # if this is the first read for this sample, create a dict
-                # to record the relevant information.
-                samples[m[1]] = {'R1': 0, 'R2': 0, 'name': m[1], 'lane': lane}
+        samples[(project, lane, name)][read] = line_count
 
-            if m[2] not in ['R1', 'R2']:
-                raise ValueError("could not parse '%s'" % basename(item))
-
-            samples[m[1]][m[2]] = line_count
+    sample_ids = []
+    lanes = []
+    counts = []
 
-        # convert samples into a set of lists for easy conversion into a
-        # dataframe.
-        for sample in samples:
-            smpl = samples[sample]
-            if smpl['R1'] == 0 or smpl['R2'] == 0:
-                raise ValueError(f"{smpl['name']} has bad counts")
+    # convert samples into a set of lists for easy conversion into a
+    # dataframe.
+    for smpl in samples.values():
+        if smpl['R1'] == 0 or smpl['R2'] == 0:
+            raise ValueError(f"{smpl['name']} has bad counts")
 
-            sample_ids.append(smpl['name'])
-            lanes.append(smpl['lane'])
-            counts.append(float(smpl['R1'] + smpl['R2']))
+        sample_ids.append(smpl['name'])
+        lanes.append(smpl['lane'])
+        counts.append(float(smpl['R1'] + smpl['R2']))
 
     df = pd.DataFrame(list(zip(sample_ids, lanes, counts)),
                       columns=['Sample_ID', 'Lane',
@@ -320,6 +445,9 @@ def run_counts(run_dir, metadata):
     :param metadata: A sample-sheet (metagenomic) or mapping-file (amplicon)
     :return: pandas.DataFrame
     '''
+    # the raw and fastp counts only parse small stats files, read them first
+    # so a missing or malformed one fails before any sequence file is
+    # decompressed. The sequence files are counted in parallel internally.
     out = raw_read_counts(run_dir, metadata).join(
         [fastp_counts(run_dir, metadata),
          direct_sequence_counts(run_dir, metadata)])
@@ -328,6 +456,4 @@ def run_counts(run_dir, metadata):
     ratio = out['quality_filtered_reads_r1r2'] / out['raw_reads_r1r2']
     out['fraction_passing_quality_filter'] = ratio
 
-    out.fillna(value='NA', inplace=True)
-
     return out
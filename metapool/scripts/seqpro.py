@@ -38,6 +38,11 @@ def format_preparation_files(run_dir, sample_sheet, output_dir, verbose):
     df_sheet = sample_sheet_to_dataframe(sample_sheet)
 
     stats = run_counts(run_dir, sample_sheet)
+
+    # counts are kept numeric, missing values are only written out as NA
+    # when merging them into the preparations
+    na_counts = {column: 'NA' for column in stats.columns}
+
     stats['sample_name'] = \
         df_sheet.set_index('lane', append=True)['sample_name']
 
@@ -60,7 +65,8 @@ def format_preparation_files(run_dir, sample_sheet, output_dir, verbose):
         # stats are indexed by sample name and lane, lane is the first
         # level index. When merging, make sure to select the lane subset
         # that we care about, otherwise we'll end up with repeated rows
-        df = df.merge(stats.xs(lane, level=1), how='left', on='sample_name')
+        df = df.merge(stats.xs(lane, level=1).fillna(na_counts),
+                      how='left', on='sample_name')
 
         # strip qiita_id from project names in sample_project column
         df['sample_project'] = df['sample_project'].map(
@@ -491,8 +491,8 @@ class MetricsTest(unittest.TestCase):
             # values below should reflect values extracted from fastp-
             # generated json files.
             "total_biological_reads_r1r2": {0: 55785054.0, 1: 41738784.0},
-            # values below should reflect # of sequences found in a fastq file
-            # by seqtk.
+            # values below should reflect # of sequences found in the
+            # filtered fastq files for both forward and reverse reads.
             "quality_filtered_reads_r1r2": {0: 4.0, 1: 4.0},
             "fraction_passing_quality_filter": {
                 0: 6.699090936709433e-08,
@@ -1,14 +1,27 @@
+import gzip
 import json
 import os
+import re
 import tempfile
 import shutil
 import pandas as pd
 from sample_sheet import Sample
-from unittest import main, TestCase
+from unittest import main, TestCase, skipIf
+from unittest.mock import patch
 from metapool.sample_sheet import MetagenomicSampleSheetv90
 from metapool.count import (_extract_name_and_lane, _parse_fastp_counts,
                             raw_read_counts, fastp_counts, run_counts,
-                            _parsefier)
+                            _parsefier, _count_sequences_in_fastq)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
 
 
 class TestCount(TestCase):
@@ -89,6 +102,80 @@ class TestCount(TestCase):
 
         pd.testing.assert_frame_equal(obs.sort_index(), exp)
 
+    def test_parsefier_ignores_samples_not_in_sheet(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-with-unexpected-logs')
+            shutil.copytree(self.run_dir, run)
+
+            # a log for a sample that's not in the sheet should neither show
+            # up in the output nor hide the samples that are missing a log
+            fake = os.path.join(run, 'Trojecp_666', 'json',
+                                'sample99_S999_L003_R1_001.json')
+            with open(fake, 'w') as f:
+                f.write(json.dumps({}))
+
+            self.ss.add_sample(Sample({
+                'Sample_ID': 'H20_Myers',
+                'Lane': '1',
+                'Sample_Name': 'H20_Myers',
+                'index': 'ACTTTGTTGGAA',
+                'index2': 'GGTTAATTGAGA',
+                'Sample_Project': 'Trojecp_666'
+            }))
+
+            with self.assertWarnsRegex(UserWarning, 'No halloween log found '
+                                       'for these samples: H20_Myers'):
+                obs = _parsefier(run, self.ss, 'json', '.json',
+                                 'halloween', lambda x: 1)
+
+        self.assertEqual(sorted(obs.index), sorted(self.stats.index))
+
+    def test_parsefier_missing_log_directories(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-without-json-logs')
+            shutil.copytree(self.run_dir, run)
+
+            # a missing directory and a file in place of a directory are
+            # both treated as a project without logs
+            shutil.rmtree(os.path.join(run, 'Trojecp_666', 'json'))
+            shutil.rmtree(os.path.join(run, 'Project_1111', 'json'))
+            with open(os.path.join(run, 'Project_1111', 'json'), 'w') as f:
+                f.write('')
+
+            with self.assertWarnsRegex(UserWarning, 'No halloween log found '
+                                       'for these samples: '):
+                obs = _parsefier(run, self.ss, 'json', '.json',
+                                 'halloween', lambda x: 1)
+
+        self.assertEqual(len(obs), 0)
+
+    def test_parsefier_ignores_hidden_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-with-hidden-files')
+            shutil.copytree(self.run_dir, run)
+
+            # a temporary file left behind by a partial copy, its name lacks
+            # the cell number so it would raise if it wasn't skipped
+            fake = os.path.join(run, 'Trojecp_666', 'json',
+                                '.sample3_L003_R1_001.json')
+            with open(fake, 'w') as f:
+                f.write('')
+
+            obs = _parsefier(run, self.ss, 'json', '.json', 'halloween',
+                             lambda x: 1)
+
+        self.assertEqual(sorted(obs.index), sorted(self.stats.index))
+
+    def test_parsefier_wildcard_suffix(self):
+        obs = _parsefier(self.run_dir, self.ss, 'json', '*.json',
+                         'halloween', lambda x: 1)
+        self.assertEqual(sorted(obs.index), sorted(self.stats.index))
+
+        with self.assertWarnsRegex(UserWarning, 'No halloween log found'):
+            obs = _parsefier(self.run_dir, self.ss, 'json', '*.log',
+                             'halloween', lambda x: 1)
+        self.assertEqual(len(obs), 0)
+
     def test_parse_fastp_malformed(self):
         with tempfile.NamedTemporaryFile('w+') as tmp:
             tmp.write(json.dumps({}))
@@ -122,6 +209,86 @@ class TestCount(TestCase):
 
         self.assertEqual(obs, 4692)
 
+    def _assert_parse_fastp(self):
+        obs = _parse_fastp_counts(
+            os.path.join(self.run_dir, 'Trojecp_666', 'json',
+                         'sample3_S457_L003_R1_001.json'))
+        self.assertEqual(obs, 4692)
+
+        valid = json.dumps({'summary': {'after_filtering': {'total_reads':
+                                                            10}}})
+        # logs truncated before the count are common when a job is killed,
+        # the rest are missing the required keys
+        for contents in [valid[:valid.index('total_reads')], json.dumps({}),
+                         json.dumps({'summary': {}}),
+                         json.dumps({'summary': {'after_filtering': {}}})]:
+            with tempfile.NamedTemporaryFile('w') as tmp:
+                tmp.write(contents)
+                tmp.flush()
+
+                with self.assertRaisesRegex(ValueError, 'The fastp log for '
+                                                        f'{tmp.name} is'
+                                                        ' malformed'):
+                    _parse_fastp_counts(tmp.name)
+
+    def test_parse_fastp_counts_without_ijson(self):
+        with patch('metapool.count.ijson', None):
+            self._assert_parse_fastp()
+
+    @skipIf(ijson is None, 'ijson is not installed')
+    def test_parse_fastp_counts_with_ijson(self):
+        with patch('metapool.count.ijson', ijson):
+            self._assert_parse_fastp()
+
+    def test_count_sequences_in_fastq(self):
+        obs = _count_sequences_in_fastq(
+            os.path.join(self.run_dir, 'Trojecp_666', 'filtered_sequences',
+                         'sample3_S457_L003_R1_001.trimmed.fastq.gz'))
+
+        self.assertEqual(obs, 8)
+
+    def _write_fastq(self, tmp, data, compress=True):
+        fp = os.path.join(tmp, 'sample_S1_L001_R1_001.trimmed.fastq.gz')
+        with (gzip.open if compress else open)(fp, 'wb') as f:
+            f.write(data)
+        return fp
+
+    def _assert_count_sequences_in_fastq(self):
+        record = b'@r1\nACGT\n+\nFFFF\n'
+        for data, exp in [(b'', 0),
+                          (record * 300000, 300000),
+                          # no trailing newline
+                          (record + record[:-1], 2),
+                          # a single trailing blank line
+                          (record * 2 + b'\n', 2)]:
+            with tempfile.TemporaryDirectory() as tmp:
+                fp = self._write_fastq(tmp, data)
+                self.assertEqual(_count_sequences_in_fastq(fp), exp)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = self._write_fastq(tmp, b'@r1\nACGT\n+\n')
+            with self.assertRaisesRegex(ValueError, 'does not look like a '
+                                                    'FASTQ file, it has 3 '
+                                                    'lines'):
+                _count_sequences_in_fastq(fp)
+
+    def test_count_sequences_in_fastq_with_gzip(self):
+        with patch('metapool.count.gzip_open', gzip.open):
+            self._assert_count_sequences_in_fastq()
+
+    @skipIf(igzip_threaded is None, 'isal is not installed')
+    def test_count_sequences_in_fastq_with_isal(self):
+        with patch('metapool.count.gzip_open', igzip_threaded.open):
+            self._assert_count_sequences_in_fastq()
+
+    def test_count_sequences_in_fastq_not_compressed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = self._write_fastq(tmp, b'@r1\nACGT\n+\nFFFF\n',
+                                   compress=False)
+
+            with self.assertRaises(OSError):
+                _count_sequences_in_fastq(fp)
+
     def test_raw_read_counts_no_stats_file(self):
         bad_dir = os.path.join(os.path.abspath(self.run_dir), 'Trojecp_666')
 
@@ -133,6 +300,20 @@ class TestCount(TestCase):
         with self.assertRaisesRegex(IOError, msg):
             raw_read_counts(bad_dir, self.ss)
 
+    def test_raw_read_counts_multiple_stats_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            reports = os.path.join(tmp, 'Reports')
+            os.makedirs(reports)
+
+            for name in ['Demultiplex_Stats.csv', 'SeqCounts.csv']:
+                with open(os.path.join(reports, name), 'w') as f:
+                    f.write('')
+
+            msg = (f"multiple metadata files exist: {reports}/Demultiplex_"
+                   f"Stats.csv, {reports}/SeqCounts.csv")
+            with self.assertRaisesRegex(IOError, re.escape(msg)):
+                raw_read_counts(tmp, self.ss)
+
     def test_raw_read_counts_malformed_results(self):
         with tempfile.TemporaryDirectory() as tmp:
             stats = os.path.join(tmp, 'Stats')
@@ -182,10 +363,59 @@ class TestCount(TestCase):
         exp = self.stats[['total_biological_reads_r1r2']]
         pd.testing.assert_frame_equal(obs.sort_index(), exp)
 
+    def test_count_collector_no_stats_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-without-stats')
+            shutil.copytree(self.run_dir, run)
+            shutil.rmtree(os.path.join(run, 'Stats'))
+
+            # the missing stats file should be reported before any of the
+            # sequence files are decompressed
+            with patch('metapool.count._count_sequences_in_fastq') as count:
+                with self.assertRaisesRegex(IOError, 'Cannot find '
+                                                     'Stats.json'):
+                    run_counts(run, self.ss)
+
+            count.assert_not_called()
+
+    def test_count_collector_malformed_fastp_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-with-malformed-fastp-log')
+            shutil.copytree(self.run_dir, run)
+            with open(os.path.join(run, 'Trojecp_666', 'json',
+                                   'sample3_S457_L003_R1_001.json'),
+                      'w') as f:
+                f.write(json.dumps({}))
+
+            # like a missing stats file, a malformed fastp log should be
+            # reported before any of the sequence files are decompressed
+            with patch('metapool.count._count_sequences_in_fastq') as count:
+                with self.assertRaisesRegex(ValueError, 'The fastp log for '
+                                                        '.* is malformed'):
+                    run_counts(run, self.ss)
+
+            count.assert_not_called()
+
     def test_count_collector(self):
         obs = run_counts(self.run_dir, self.ss)
         pd.testing.assert_frame_equal(obs.sort_index(), self.stats)
 
+    def test_count_collector_missing_counts_stay_numeric(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = os.path.join(tmp, 'run-without-sample3-logs')
+            shutil.copytree(self.run_dir, run)
+            os.remove(os.path.join(run, 'Trojecp_666', 'json',
+                                   'sample3_S457_L003_R1_001.json'))
+
+            with self.assertWarnsRegex(UserWarning, 'No total_biological_'
+                                       'reads_r1r2 log found for these '
+                                       'samples: sample3'):
+                obs = run_counts(run, self.ss)
+
+        self.assertEqual(obs['total_biological_reads_r1r2'].dtype, 'float64')
+        self.assertTrue(
+            pd.isna(obs.loc[('sample3', '3'), 'total_biological_reads_r1r2']))
+
 
 RUN_STATS = {
     'raw_reads_r1r2': {('sample1', '1'): 10000, ('sample2', '1'): 100000,
@@ -46,10 +46,13 @@ test = ['nose >= 1.3.7', 'pep8 >= 1.7.1', 'flake8 >= 7.1.1']
 
 coverage = ['coverage >= 7.6.8']
 
+# optional dependencies that speed up collecting run counts
+speedups = ['ijson >= 3.2.0', 'isal >= 1.6.0']
+
 notebook = ['jupyter >= 1.1.1', 'jupyter_contrib_nbextensions >= 0.7.0',
             'notebook >= 6.5.7', 'watermark >= 2.5.0']
 
-all_deps = base + test + coverage + notebook
+all_deps = base + test + coverage + notebook + speedups
 
 notebooks_fp = []
 for fp in glob('notebooks/*.ipynb'):
@@ -75,6 +78,7 @@ setup(name='metapool',
       install_requires=base,
       extras_require={'test': test,
                       'coverage': coverage,
+                      'speedups': speedups,
                       'all': all_deps},
       entry_points={
           'console_scripts': [